@@ -1,6 +1,7 @@
-from src import DiscordDownloader, get_args
+from src import DiscordDownloader, configure_logger, get_args
 
 if __name__ == '__main__':
     options = vars(get_args())
+    configure_logger(options['verbose'], options['quiet'])
     dd = DiscordDownloader(options)
-    dd.run()
\ No newline at end of file
+    dd.run()
@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from src.utils import datetime_to_snowflake
+
+# attachment types and how big they are compared to --size, so the filters and --download-order have something to work with
+ATTACHMENT_TYPES = (('png', 'image/png', 0.5), ('mp4', 'video/mp4', 2), ('bin', 'application/octet-stream', 1), ('jpg', 'image/jpeg', 0.25))
+
+def get_benchmark_args():
+    parser = argparse.ArgumentParser(description='Benchmark discord_dl against a local mock of the Discord API and CDN')
+    parser.add_argument('--messages', type=int, help='Messages in each mock channel, Default is 2000', default=2000)
+    parser.add_argument('--channels', type=int, help='How many mock channels to download, Default is 1', default=1)
+    parser.add_argument('--attachments', type=int, help='Attachments on each message, Default is 1', default=1)
+    parser.add_argument('--size', type=int, help='Average size of the attachments in KB, Default is 64', default=64)
+    parser.add_argument('--duplicates', type=float, help='Fraction of attachments with the same content as another attachment, Default is 0', default=0)
+    parser.add_argument('--latency', type=float, help='Seconds the mock server waits before answering each request, Default is 0', default=0)
+    parser.add_argument('--rate-limit-rate', type=float, help='Fraction of API requests answered with 429, Default is 0', default=0)
+    parser.add_argument('--error-rate', type=float, help='Fraction of requests answered with 503, Default is 0', default=0)
+    parser.add_argument('--concurrency', type=int, help='Passed on to the downloader, Default is 1', default=1)
+    parser.add_argument('--channel-concurrency', type=int, help='Passed on to the downloader, Default is 1', default=1)
+    parser.add_argument('--dedupe', action='store_true', help='Passed on to the downloader')
+    parser.add_argument('--download-order', type=str, choices=['message', 'smallest', 'largest'], help='Passed on to the downloader, Default is message', default='message')
+    parser.add_argument('--content-type', type=str, nargs='*', help='Passed on to the downloader', default=[])
+    parser.add_argument('--seed', type=int, help='Seed for the injected errors, Default is 0', default=0)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    return parser.parse_args()
+
+def create_attachment(channel_id:int, attachment_id:int, name:str, size:int, base_url:str) -> dict:
+    ext, content_type, scale = ATTACHMENT_TYPES[attachment_id % len(ATTACHMENT_TYPES)]
+    return {
+        'id': str(attachment_id),
+        'filename': f'{name}.{ext}',
+        'size': max(1, int(size * scale)),
+        'content_type': content_type,
+        'url': f'{base_url}/attachments/{channel_id}/{attachment_id}/{name}.{ext}',
+    }
+
+def create_messages(channel_id:int, count:int, attachments:int, size:int, base_url:str, attachment_ids:Iterator[int]) -> list:
+    # newest first, like the discord api returns them
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for i in range(count):
+        date = start + timedelta(minutes=i)
+        message_id = datetime_to_snowflake(date) + channel_id
+        messages.append({
+            'id': str(message_id),
+            'timestamp': date.isoformat(),
+            'author': {'id': str(i % 7), 'username': f'user{i % 7}'},
+            'attachments': [
+                # the counter is shared by every channel so attachment ids never repeat
+                create_attachment(channel_id, datetime_to_snowflake(date) + next(attachment_ids), f'file_{i}_{j}', size, base_url)
+                for j in range(attachments)
+            ],
+        })
+    messages.reverse()
+    return messages
+
+class MockDiscordHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real api and cdn
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, without this delayed acks stall every kept alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self.send_stats()
+        route = re.sub(r'/\d+', '/{id}', url.path)
+        if route.startswith('/attachments/'):
+            route = '/attachments/{id}/{id}/{filename}'
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests[route] = server.requests.get(route, 0) + 1
+            roll = server.random.random()
+        if roll < server.error_rate:
+            return self.send_body(503, b'')
+        if route.startswith('/api/') and roll < server.error_rate + server.rate_limit_rate:
+            with server.lock:
+                server.rate_limited += 1
+            return self.send_json({'message': 'You are being rate limited.', 'retry_after': 0.05, 'global': False}, 429)
+        if route == '/api/v9/channels/{id}/messages':
+            return self.send_messages(url)
+        if route == '/api/v9/channels/{id}':
+            channel_id = url.path.split('/')[-1]
+            return self.send_json({'id': channel_id, 'guild_id': '1', 'name': f'channel-{channel_id}', 'topic': None})
+        if route == '/api/v9/guilds/{id}':
+            return self.send_json({'id': '1', 'name': 'benchmark', 'owner_id': '1'})
+        if route == '/attachments/{id}/{id}/{filename}':
+            return self.send_attachment(url.path)
+        self.send_body(404, b'')
+
+    # --dedupe asks for the etag before downloading
+    do_HEAD = do_GET
+
+    def send_stats(self) -> None:
+        # the counters are reset after being read so every phase only sees its own requests
+        server = self.server
+        with server.lock:
+            stats = {'requests': server.requests, 'rate_limited': server.rate_limited, 'bytes_sent': server.bytes_sent}
+            server.requests = {}
+            server.rate_limited = 0
+            server.bytes_sent = 0
+        self.send_json(stats)
+
+    def send_messages(self, url) -> None:
+        query = parse_qs(url.query)
+        messages = self.server.channels.get(int(url.path.split('/')[-2]), [])
+        limit = int(query.get('limit', [50])[0])
+        if 'before' in query:
+            before = int(query['before'][0])
+            messages = [message for message in messages if int(message['id']) < before]
+        if 'after' in query:
+            after = int(query['after'][0])
+            messages = [message for message in messages if int(message['id']) > after][-limit:]
+        self.send_json(messages[:limit])
+
+    def send_attachment(self, path:str) -> None:
+        attachment_id = int(path.split('/')[3])
+        size = self.server.attachment_sizes[attachment_id]
+        # duplicates share their content with every other duplicate of the same size
+        content = b'duplicate' if attachment_id in self.server.duplicates else path.encode()
+        body = (content * (size // len(content) + 1))[:size]
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_body(304, b'')
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        headers = {'ETag': etag}
+        if match and int(match.group(1)) < len(body) and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+        if self.command == 'HEAD':
+            return self.send_body(200, b'', headers, len(body))
+        with self.server.lock:
+            self.server.bytes_sent += len(body) - start
+        self.send_body(206 if start else 200, body[start:], headers)
+
+    def send_json(self, data, status:int=200) -> None:
+        self.send_body(status, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+    def send_body(self, status:int, body:bytes, headers:dict=None, length:int=None) -> None:
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MockDiscordServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args) -> None:
+        super().__init__(('127.0.0.1', 0), MockDiscordHandler)
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.latency = args.latency
+        self.error_rate = args.error_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.rate_limited = 0
+        self.bytes_sent = 0
+        attachment_ids = itertools.count(1)
+        self.channels = {
+            channel_id: create_messages(channel_id, args.messages, args.attachments, args.size * 2**10, self.base_url, attachment_ids)
+            for channel_id in range(1, args.channels + 1)
+        }
+        self.attachment_sizes = {}
+        self.duplicates = set()
+        for messages in self.channels.values():
+            for message in messages:
+                for attachment in message['attachments']:
+                    self.attachment_sizes[int(attachment['id'])] = attachment['size']
+                    if self.random.random() < args.duplicates:
+                        self.duplicates.add(int(attachment['id']))
+
+def serve(args, connection) -> None:
+    # its own process so the mock channels and the server threads do not count towards the downloaders memory
+    server = MockDiscordServer(args)
+    connection.send((server.base_url, server.channels[1]))
+    connection.close()
+    server.serve_forever()
+
+def get_stats(base_url:str) -> dict:
+    with urllib.request.urlopen(f'{base_url}/stats') as response:
+        return json.loads(response.read())
+
+def get_peak_rss() -> int:
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 2**10
+
+def run_downloader(options:dict, connection) -> None:
+    # a fresh process so the peak memory is the downloaders alone
+    from src import DiscordDownloader
+    start = time.perf_counter()
+    DiscordDownloader(options).run()
+    connection.send((time.perf_counter() - start, get_peak_rss()))
+    connection.close()
+
+def benchmark(args) -> dict:
+    from src.discord_dl import DiscordDownloader
+    from src.ratelimit import RateLimiter
+    from src.utils import create_attachment_variables, create_message_variables
+    import requests
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    server = context.Process(target=serve, args=(args, sender), daemon=True)
+    server.start()
+    base_url, raw_messages = receiver.recv()
+    report = {}
+    with tempfile.TemporaryDirectory() as path:
+        options = {
+            'token': 'benchmark',
+            'api_url': f'{base_url}/api/v9',
+            'channel_ids': [str(channel_id) for channel_id in range(1, args.channels + 1)],
+            'path': path,
+            'concurrency': args.concurrency,
+            'channel_concurrency': args.channel_concurrency,
+            'dedupe': args.dedupe,
+            'download_order': args.download_order,
+            'content_type': args.content_type,
+        }
+        dd = DiscordDownloader(options)
+        api = RateLimiter(requests.Session(), dd.max_retries)
+
+        start = time.perf_counter()
+        # counted instead of kept, like a real run
+        count = sum(1 for _ in dd.get_all_messages(api, '1'))
+        elapsed = time.perf_counter() - start
+        report['get_all_messages'] = {'messages': count, 'seconds': elapsed, 'messages_per_second': count / elapsed}
+
+        # with filters that every message has to be checked against
+        filtering = DiscordDownloader({**options, 'date_after': datetime(2019, 12, 31), 'username': ['user1', 'user2'], 'user_id': ['1', '2']})
+        start = time.perf_counter()
+        filtering.find_messages(raw_messages)
+        elapsed = time.perf_counter() - start
+        report['find_messages'] = {'messages': len(raw_messages), 'seconds': elapsed, 'messages_per_second': len(raw_messages) / elapsed}
+
+        channel_variables = dd.get_channel_info(api, '1')
+        attachments = sum(len(message['attachments']) for message in raw_messages)
+        start = time.perf_counter()
+        # the same work as submit_attachments, message variables once per message
+        for message in raw_messages:
+            message_variables = {**create_message_variables(message), **channel_variables}
+            for attachment in message['attachments']:
+                dd.channel_template.format({**create_attachment_variables(attachment), **message_variables})
+        elapsed = time.perf_counter() - start
+        report['format_filepath'] = {'attachments': attachments, 'seconds': elapsed, 'attachments_per_second': attachments / elapsed}
+
+        get_stats(base_url)
+        receiver, sender = context.Pipe(duplex=False)
+        runner = context.Process(target=run_downloader, args=(options, sender))
+        runner.start()
+        elapsed, peak_rss = receiver.recv()
+        runner.join()
+        stats = get_stats(base_url)
+        downloaded = stats['bytes_sent'] / 2**20
+        report['run'] = {
+            'channels': args.channels,
+            'seconds': elapsed,
+            'megabytes': downloaded,
+            'megabytes_per_second': downloaded / elapsed,
+            'requests': stats['requests'],
+            'rate_limited': stats['rate_limited'],
+        }
+    report['peak_rss_megabytes'] = peak_rss / 2**20
+    server.terminate()
+    return report
+
+def print_report(report:dict) -> None:
+    print(f"get_all_messages  {report['get_all_messages']['messages_per_second']:>14,.0f} messages/s")
+    print(f"find_messages     {report['find_messages']['messages_per_second']:>14,.0f} messages/s")
+    print(f"format_filepath   {report['format_filepath']['attachments_per_second']:>14,.0f} attachments/s")
+    print(f"run               {report['run']['megabytes_per_second']:>14,.2f} MB/s ({report['run']['megabytes']:.1f} MB in {report['run']['seconds']:.2f} s)")
+    for route, count in sorted(report['run']['requests'].items()):
+        print(f"  {count:>8} {route}")
+    print(f"  {report['run']['rate_limited']:>8} rate limited")
+    print(f"run peak RSS      {report['peak_rss_megabytes']:>14,.1f} MB")
+
+if __name__ == '__main__':
+    args = get_benchmark_args()
+    report = benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
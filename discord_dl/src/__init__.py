@@ -1,2 +1,3 @@
-from src.discord_dl import DiscordDownloader
-from src.arguments import get_args
\ No newline at end of file
+from .discord_dl import DiscordDownloader
+from .arguments import get_args
+from .logger import configure_logger
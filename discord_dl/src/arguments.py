@@ -101,7 +101,7 @@ def get_args():
     parser.add_argument(
         '--sleep',
         type=int,
-        help='How long to sleep in between downloading attachments and retrieving messages, Default is 0',
+        help='How long to sleep in between downloading attachments and retrieving messages, Discord rate limits are followed without it, Default is 0',
         default=0
     )
 
@@ -120,6 +120,48 @@ def get_args():
         default=10
     )
 
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help='Seconds to wait for a connection or for more data before a request is retried, Default is 30',
+        default=30
+    )
+
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        help='How many attachments to download at the same time, Default is 1',
+        default=1
+    )
+
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        help='The maximum number of attachments waiting for a free download slot, Default is twice --concurrency',
+        default=None
+    )
+
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        help='How many connections to the attachment CDN to keep open for reuse, Default is --concurrency',
+        default=None
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        help='How many KB to read from the network at a time while downloading an attachment, Default is 256',
+        default=256
+    )
+
+    parser.add_argument(
+        '--channel-concurrency',
+        type=int,
+        help='How many channels to get messages from at the same time, all channels share the --concurrency download slots, Default is 1',
+        default=1
+    )
+
     parser.add_argument(
         '--user-id',
         type=str,
@@ -136,6 +178,51 @@ def get_args():
         default=[]
     )
 
+    parser.add_argument(
+        '--min-size',
+        type=int,
+        help='Only download attachments of at least this many KB',
+        default=None
+    )
+
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        help='Only download attachments of at most this many KB',
+        default=None
+    )
+
+    parser.add_argument(
+        '--content-type',
+        type=str,
+        help='Only download attachments with these content type(s), wildcards are allowed (image/*,video/mp4)',
+        action=ListAction,
+        default=[]
+    )
+
+    parser.add_argument(
+        '--ext',
+        type=str,
+        help='Only download attachments with these file extension(s) (png,jpg,mp4)',
+        action=ListAction,
+        default=[]
+    )
+
+    parser.add_argument(
+        '--download-order',
+        type=str,
+        choices=['message', 'smallest', 'largest'],
+        help='The order waiting attachments are downloaded in, only attachments in the --queue-size window are reordered, Default is message',
+        default='message'
+    )
+
+    parser.add_argument(
+        '--large-file-size',
+        type=int,
+        help='Download attachments of at least this many KB one at a time on their own so they do not hold up smaller files',
+        default=None
+    )
+
     parser.add_argument(
         '--message-count',
         type=int,
@@ -167,6 +254,73 @@ def get_args():
         default=None
     )
 
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Keep a state file in --path with the newest message seen in each channel and every downloaded attachment, later runs only get new messages and skip known attachments',
+    )
+
+    parser.add_argument(
+        '--metadata-ttl',
+        type=int,
+        help='Reuse server and channel info saved in the state file for this many seconds instead of requesting it again, also how long --watch keeps it in memory which is --max-poll-interval when 0, Default is 0',
+        default=0
+    )
+
+    parser.add_argument(
+        '--dedupe',
+        action='store_true',
+        help='Hardlink attachments whose content was already downloaded to another path instead of downloading them again, files are copied when a hardlink is not possible',
+    )
+
+    parser.add_argument(
+        '--export-index',
+        type=str,
+        help='Save the messages with attachments and the channel info of every channel to this file, one JSON object per line, added to the end of the file when using --sync',
+        default=None
+    )
+
+    parser.add_argument(
+        '--import-index',
+        type=str,
+        help='Download attachments from a file saved with --export-index instead of getting messages from Discord, only channel ids in the file are used if none are given',
+        default=None
+    )
+
+    parser.add_argument(
+        '--metrics',
+        type=str,
+        help='Write timings and counters for every phase, channel and request type to this file when done, as JSON or as a Prometheus textfile when the name ends with .prom',
+        default=None
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        help='Profile every thread with cProfile and write the combined stats to this file when done',
+        default=None
+    )
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep running and poll every channel for new messages, download their attachments as they appear',
+    )
+
+    parser.add_argument(
+        '--poll-interval',
+        type=int,
+        help='Seconds between polls of a channel with new messages when using --watch, quiet channels are polled less often, Default is 60',
+        default=60
+    )
+
+    parser.add_argument(
+        '--max-poll-interval',
+        type=int,
+        help='The most seconds between polls of a quiet channel when using --watch, Default is 3600',
+        default=3600
+    )
+
     parser.add_argument(
         '--simulate',
         action='store_true',
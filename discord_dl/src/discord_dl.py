@@ -1,13 +1,33 @@
-import requests
+import logging
+import fnmatch
+import heapq
+import itertools
+import mimetypes
+import re
+import sys
+import threading
 import time
 import os
-from src.utils import download, extract_channel_ids, convert_discord_timestamp, mysleep, create_format_variables, create_filepath
-from src.logger import logger
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from typing import Iterator
+from .utils import DOWNLOAD_CHUNK_SIZE, download, extract_channel_ids, link_file, mysleep, create_message_variables, create_attachment_variables, datetime_to_snowflake
+from .logger import logger
+from .metrics import Metrics
+from .index import IndexWriter, read_index_channels, read_index_messages
+from .progress import Progress
+from .ratelimit import RateLimiter
+from .state import StateStore
+from .template import PathTemplate
+from .workers import TaskGroup, WorkerPool
+
+API_URL = 'https://discord.com/api/v9'
 
 class DiscordDownloader():
 
     def __init__(self, options:dict) -> None:
         self.token = options.get('token', None)
+        self.api_url = options.get('api_url', API_URL)
         self.path = options.get('path', os.getcwd())
         self.file = options.get('file', None)
         self.channel_ids = options.get('channel_ids', [])
@@ -15,34 +35,140 @@ class DiscordDownloader():
         self.sleep = options.get('sleep', 0)
         self.sleep_random = options.get('sleep_random', [0,0])
         self.max_retries = options.get('max_retries', 10)
+        self.timeout = options.get('timeout', 30)
         self.date = options.get('date', None)
         self.date_before = options.get('date_before', None)
         self.date_after = options.get('date_after', None)
         self.username = options.get('username', [])
         self.user_id = options.get('user_id', [])
+        self.usernames = set(self.username)
+        self.user_ids = set(self.user_id)
         self.channel_format = options.get('channel_format', 'downloads/{date:%Y-%m-%d}_{id}_{filename}.{ext}')
         self.dm_format = options.get('dm_format', 'downloads/{date:%Y-%m-%d}_{id}_{filename}.{ext}')
         self.windows_filenames = options.get('windows_filenames', False)
         self.restrict_filenames = options.get('restrict_filenames', False)
         self.simulate = options.get('simulate', False)
+        self.concurrency = max(1, options.get('concurrency', 1))
+        self.queue_size = options.get('queue_size', None) or self.concurrency * 2
+        self.channel_concurrency = max(1, options.get('channel_concurrency', 1))
+        self.pool_size = options.get('pool_size', None) or self.concurrency
+        self.chunk_size = options.get('chunk_size', DOWNLOAD_CHUNK_SIZE // 2**10) * 2**10
+        self.sync = options.get('sync', False)
+        self.dedupe = options.get('dedupe', False)
+        self.min_size = options.get('min_size', None)
+        self.max_size = options.get('max_size', None)
+        self.content_types = options.get('content_type', [])
+        self.extensions = {ext.lower().lstrip('.') for ext in options.get('ext', [])}
+        self.download_order = options.get('download_order', 'message')
+        self.large_file_size = options.get('large_file_size', None)
+        self.large_pool = None
+        self.watch = options.get('watch', False)
+        self.poll_interval = options.get('poll_interval', 60)
+        self.max_poll_interval = max(self.poll_interval, options.get('max_poll_interval', 3600))
+        self.poll_intervals = {}
+        self.schedule = []
+        self.schedule_condition = threading.Condition()
+        self.metrics_file = options.get('metrics', None)
+        self.metrics = Metrics()
+        self.profile_file = options.get('profile', None)
+        self.metadata_ttl = options.get('metadata_ttl', 0)
+        # --watch never finishes so renamed channels and servers have to be picked up eventually
+        self.metadata_lifetime = self.metadata_ttl or (self.max_poll_interval if self.watch else 0)
+        self.export_index = options.get('export_index', None)
+        self.import_index = options.get('import_index', None)
+        self.index = None
+        self.metadata_cache = {}
+        self.metadata_lock = threading.Lock()
+        self.quiet = options.get('quiet', False)
+        # the bar is only for people watching a terminal
+        self.progress = Progress(enabled=not self.quiet and sys.stdout.isatty())
+        self.state = None
+        self.newest_message_ids = {}
+        self.cursors = {}
+        self.failed_channel_ids = set()
+        # requests.exceptions.RequestException, set once requests is loaded in run_channels
+        self.request_error = None
+        # set on ctrl-c or any other error so the workers wind down instead of finishing the whole run
+        self.stopped = threading.Event()
 
         if self.token == None:
-            raise (f"No discord auth token passed")
+            raise ValueError("No discord auth token passed")
 
         for key, value in options.items():
             if key == 'token':
-                logger.debug(f"{key}: '**********'")
+                logger.debug("%s: '**********'", key)
             else:
-                logger.debug(f"{key}: {value}")
+                logger.debug("%s: %s", key, value)
 
         if not os.path.exists(self.path):
-            raise (f"Download path does not exist: {self.path}")
+            raise ValueError(f"Download path does not exist: {self.path}")
+
+        if self.export_index and self.import_index:
+            raise ValueError("--export-index and --import-index can not be used together")
         
+        # bad templates should fail here, before any requests are made
+        self.channel_template = PathTemplate(self.channel_format, self.path, self.windows_filenames, self.restrict_filenames)
+        self.dm_template = PathTemplate(self.dm_format, self.path, self.windows_filenames, self.restrict_filenames, server=False)
         self.channel_ids = extract_channel_ids(self.channel_ids)
+        self.after_id, self.before_id = self.get_message_id_bounds()
+
+    def get_message_id_bounds(self) -> tuple:
+        # messages with after_id < id < before_id pass the date filters
+        after_id = None
+        before_id = None
+        if self.date:
+            after_id = datetime_to_snowflake(self.date) - 1
+            before_id = datetime_to_snowflake(self.date + timedelta(days=1))
+        if self.date_before:
+            bound = datetime_to_snowflake(self.date_before)
+            before_id = bound if before_id is None else min(before_id, bound)
+        if self.date_after:
+            bound = datetime_to_snowflake(self.date_after + timedelta(days=1)) - 1
+            after_id = bound if after_id is None else max(after_id, bound)
+        logger.debug("Message id bounds: after %s before %s", after_id, before_id)
+        return after_id, before_id
+
+    def get_metadata(self, kind:str, key:str, fetch) -> dict:
+        with self.metrics.timer('metadata', kind=kind):
+            return self.get_cached_metadata(kind, key, fetch)
+
+    def get_cached_metadata(self, kind:str, key:str, fetch) -> dict:
+        # the first caller for a key fetches it, everyone else waits on the same future
+        with self.metadata_lock:
+            future, fetched_at = self.metadata_cache.get((kind, key), (None, 0))
+            now = time.monotonic()
+            if future is not None and future.done() and self.metadata_lifetime and now - fetched_at > self.metadata_lifetime:
+                logger.debug("Cached %s info for id %s expired", kind, key)
+                future = None
+            owner = future is None
+            if owner:
+                future = Future()
+                self.metadata_cache[(kind, key)] = (future, now)
+        if owner:
+            try:
+                data = None
+                if self.state and self.metadata_ttl > 0:
+                    data = self.state.get_metadata(kind, key, self.metadata_ttl)
+                if data is None:
+                    self.metrics.count('metadata_requests', kind=kind)
+                    data = fetch()
+                    if self.state and self.metadata_ttl > 0:
+                        self.state.set_metadata(kind, key, data)
+                else:
+                    logger.debug("Using cached %s info for id %s", kind, key)
+                future.set_result(data)
+            except Exception as e:
+                with self.metadata_lock:
+                    del self.metadata_cache[(kind, key)]
+                future.set_exception(e)
+        return future.result()
 
     def get_server_info(self, session, guild_id:str) -> dict:
-        logger.info(f"Getting server info for server id {guild_id}")
-        response = session.get(f"https://discord.com/api/v9/guilds/{guild_id}").json()
+        return self.get_metadata('server', guild_id, lambda: self.request_server_info(session, guild_id))
+
+    def request_server_info(self, session, guild_id:str) -> dict:
+        logger.info("Getting server info for server id %s", guild_id)
+        response = session.get(f"{self.api_url}/guilds/{guild_id}").json()
         server_info = {
             'server_id':response['id'],
             'server_name':response['name'],
@@ -51,109 +177,410 @@ class DiscordDownloader():
         return server_info
 
     def get_channel_info(self, session, channel_id:str) -> dict:
-        logger.info(f"Getting channel info for channel id {channel_id}")
-        response = session.get(f"https://discord.com/api/v9/channels/{channel_id}").json()
+        channel_info = self.get_metadata('channel', channel_id, lambda: self.request_channel_info(session, channel_id))
+        # server info is cached on its own so channels of the same server share it
+        if 'guild_id' in channel_info:
+            server_info = self.get_server_info(session, channel_info['guild_id'])
+            channel_info = {key: value for key, value in channel_info.items() if key != 'guild_id'}
+            channel_info = {**channel_info, **server_info}
+        return channel_info
+
+    def request_channel_info(self, session, channel_id:str) -> dict:
+        logger.info("Getting channel info for channel id %s", channel_id)
+        response = session.get(f"{self.api_url}/channels/{channel_id}").json()
         channel_info = {'channel_id':response['id']}
         # server channel
         if 'guild_id' in response:
             channel_info['channel_name'] = response['name']
             channel_info['channel_topic'] = response['topic']
-            server_info = self.get_server_info(session, response['guild_id'])
-            channel_info = {**channel_info, **server_info}
-        return channel_info    
+            channel_info['guild_id'] = response['guild_id']
+        return channel_info
 
-    def get_all_messages(self, session, channel_id:str) -> list:
-        messages = []
-        last_message_id = None
-        while True:
+    def get_filters_key(self) -> str:
+        # sync cursors are only valid for the message and attachment filters they were recorded with
+        return repr((
+            self.date, self.date_before, self.date_after, sorted(self.username), sorted(self.user_id), self.message_count,
+            self.min_size, self.max_size, sorted(self.content_types), sorted(self.extensions)
+        ))
+
+    def get_all_messages(self, session, channel_id:str, after_id:int=None) -> Iterator[dict]:
+        # a sync cursor and the date filters both bound the crawl, the newer of the two wins
+        bounds = [bound for bound in (after_id, self.after_id) if bound is not None]
+        after_id = max(bounds) if bounds else None
+        # --message-count counts back from the newest message so only skip ahead without it
+        last_message_id = str(self.before_id) if self.before_id and self.message_count < 0 else None
+        count = 0
+        first_page = True
+        while not self.stopped.is_set():
             messages_chunk = self.retrieve_messages(session, channel_id, before_message_id=last_message_id)
-            messages += messages_chunk
+            if not messages_chunk:
+                break
+            if first_page:
+                newest_message_id = self.newest_message_ids.get(channel_id, '0')
+                self.newest_message_ids[channel_id] = max(newest_message_id, messages_chunk[0]['id'], key=int)
+                first_page = False
+            if after_id:
+                messages_chunk = [message for message in messages_chunk if int(message['id']) > after_id]
+            last_page = len(messages_chunk) < 50
+            if self.message_count >= 0 and count + len(messages_chunk) >= self.message_count:
+                messages_chunk = messages_chunk[:self.message_count - count]
+                last_page = True
+            if self.index:
+                self.index.write_messages(channel_id, messages_chunk)
+            count += len(messages_chunk)
+            yield from self.find_messages(messages_chunk)
+            if last_page:
+                break
             last_message_id = messages_chunk[-1]['id']
-            if self.message_count >= 0 and len(messages) >= self.message_count:
-                logger.debug(f"Got {len(messages[:self.message_count])} messages for channel id {channel_id}")
-                return self.find_messages(messages[:self.message_count])
-            if len(messages_chunk) < 50:
-                logger.debug(f"Got {len(messages)} messages for channel id {channel_id}")
-                return self.find_messages(messages)
-            mysleep(self.sleep, self.sleep_random)
+            mysleep(self.sleep, self.sleep_random, self.metrics)
+        logger.debug("Got %s messages for channel id %s", count, channel_id)
 
     def retrieve_messages(self, session, channel_id:str, before_message_id:str=None) -> list:
         params = {'limit':50}
         if before_message_id:
-            logger.info(f"Getting messages before message id {before_message_id} for channel id {channel_id}")
+            logger.info("Getting messages before message id %s for channel id %s", before_message_id, channel_id)
             params['before'] = before_message_id
         else:
-            logger.info(f"Getting messages for channel id {channel_id}")
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                messages = session.get(f'https://discord.com/api/v9/channels/{channel_id}/messages', params=params).json()
-            except ConnectionError:
-                retries += 1
-                sleep = 30 * retries
-                logger.warning(f"{messages.status_code} Failed to get messages with url: {messages.url}")   
-                logger.info(f"Sleeping for {sleep} seconds")
-                time.sleep(sleep)
-                logger.info(f"Retrying download {retries}/{self.max_retries}")
-            else:
-                return messages
+            logger.info("Getting messages for channel id %s", channel_id)
+        with self.metrics.timer('pagination', channel=channel_id):
+            response = session.get(f'{self.api_url}/channels/{channel_id}/messages', params=params)
+            if response.status_code != 200:
+                logger.warning("%s Failed to get messages with url: %s", response.status_code, response.url)
+                self.failed_channel_ids.add(channel_id)
+                return []
+            messages = response.json()
+        self.metrics.count('messages', len(messages), channel=channel_id)
+        return messages
 
     def find_messages(self, messages:list) -> list:
+        if not (self.after_id or self.before_id or self.usernames or self.user_ids):
+            return messages
+        # the date filters were turned into message id bounds, ids compare much faster than timestamps
+        after_id = self.after_id or -1
+        before_id = self.before_id or float('inf')
+        usernames = self.usernames
+        user_ids = self.user_ids
+        if not logger.isEnabledFor(logging.DEBUG):
+            return [
+                message for message in messages
+                if after_id < int(message['id']) < before_id
+                and (not usernames or message['author']['username'] in usernames)
+                and (not user_ids or message['author']['id'] in user_ids)
+            ]
         filtered_data = []
         for message in messages:
-            message_date = convert_discord_timestamp(message['timestamp']).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
-            if self.date and message_date != self.date:
-                logger.debug(f"Message date {message_date:%Y-%m-%d} != args.date {self.date:%Y-%m-%d} for message id {message['id']}")
-                continue
-            if self.date_before and message_date >= self.date_before:
-                logger.debug(f"Message date {message_date:%Y-%m-%d} >= args.date_before {self.date_before:%Y-%m-%d} for message id {message['id']}")
-                continue
-            if self.date_after and message_date <= self.date_after:
-                logger.debug(f"Message date {message_date:%Y-%m-%d} <= args.date_after {self.date_after:%Y-%m-%d} for message id {message['id']}")
+            if not after_id < int(message['id']) < before_id:
+                logger.debug("Message date %s is outside the date filters for message id %s", message['timestamp'], message['id'])
                 continue
-            if self.username and message['author']['username'] not in self.username:
-                logger.debug(f"Message username {message['author']['username']} is not in args.username {self.username} for message id {message['id']}")
+            if usernames and message['author']['username'] not in usernames:
+                logger.debug("Message username %s is not in args.username %s for message id %s", message['author']['username'], self.username, message['id'])
                 continue
-            if self.user_id and message['author']['id'] not in self.user_id:
-                logger.debug(f"Message user id {message['author']['id']} is not in args.user_id {self.user_id} for message id {message['id']}")
+            if user_ids and message['author']['id'] not in user_ids:
+                logger.debug("Message user id %s is not in args.user_id %s for message id %s", message['author']['id'], self.user_id, message['id'])
                 continue
             filtered_data.append(message)
         return filtered_data
 
+    def link_duplicate(self, attachment:dict, filepath:str) -> bool:
+        size = attachment.get('size')
+        # only ask the cdn for the hash when a file of the same size is known
+        if not size or not self.state.has_size(size):
+            return False
+        try:
+            response = self.cdn_session.head(attachment['url'], timeout=self.timeout)
+        except self.request_error:
+            return False
+        md5 = response.headers.get('ETag', '').strip('"')
+        if response.status_code != 200 or not re.fullmatch(r'[0-9a-f]{32}', md5):
+            return False
+        source = self.state.find_file(md5, size)
+        if source is None:
+            return False
+        logger.info("Linking %s to already downloaded file %s", os.path.basename(filepath), source)
+        link_file(source, filepath)
+        stat = os.stat(filepath)
+        self.state.set_md5(filepath, stat.st_size, stat.st_mtime_ns, md5)
+        return True
+
     def download_attachment(self, attachment:dict, variables:dict) -> None:
-        filepath = create_filepath(variables, self.path, self.channel_format, self.dm_format, self.windows_filenames, self.restrict_filenames)
+        template = self.channel_template if 'server_id' in variables else self.dm_template
+        filepath = template.format(variables)
+        if self.sync and self.state.is_downloaded(attachment['id'], filepath):
+            logger.info("Skipping already downloaded attachment id %s", attachment['id'])
+            self.metrics.count('attachments', channel=variables['channel_id'], result='known')
+            return
+        if not self.simulate:
+            template.makedirs(os.path.dirname(filepath))
+        if self.dedupe and not self.simulate and not os.path.exists(filepath) and self.link_duplicate(attachment, filepath):
+            self.metrics.count('attachments', channel=variables['channel_id'], result='linked')
+            if self.sync:
+                self.state.add_attachment(attachment['id'], filepath)
+            mysleep(self.sleep, self.sleep_random, self.metrics)
+            return
         retries = 0
-        while retries < self.max_retries:
-            result = download(attachment['url'], filepath, self.simulate)
+        result = None
+        while retries < self.max_retries and not self.stopped.is_set():
+            try:
+                result = download(self.cdn_session, attachment['url'], filepath, self.progress, self.simulate, None if self.simulate else self.state, self.chunk_size, self.stopped, self.timeout, self.metrics)
+            except self.request_error as e:
+                # anything already written stays in the .part file and is resumed on the next attempt
+                logger.warning("Download interrupted: %r", e)
+                result = None
             if result == 1:
                 logger.info('File already downloaded with matching hash and file name')
                 break
             elif result == 404:
-                logger.warning(f"{result} Failed to download url: {attachment['url']}")
+                logger.warning("%s Failed to download url: %s", result, attachment['url'])
                 break
-            elif result != 200:
+            elif result != 200 and not self.stopped.is_set():
                 retries += 1
                 sleep = 30 * retries
-                logger.warning(f"{result} Failed to download url: {attachment['url']}")   
-                logger.info(f"Sleeping for {sleep} seconds")
-                time.sleep(sleep)
-                logger.info(f"Retrying download {retries}/{self.max_retries}")
+                self.metrics.count('download_retries', channel=variables['channel_id'])
+                self.metrics.add_time('retry_sleep', sleep)
+                logger.warning("%s Failed to download url: %s", result, attachment['url'])   
+                logger.info("Sleeping for %s seconds", sleep)
+                self.stopped.wait(sleep)
+                logger.info("Retrying download %s/%s", retries, self.max_retries)
             else:
                 break
+        self.metrics.count('attachments', channel=variables['channel_id'], result='failed' if result is None else result)
+        if result == 200:
+            self.metrics.count('attachment_bytes', attachment.get('size', 0), channel=variables['channel_id'])
+        if result in (1, 200):
+            if self.sync and not self.simulate:
+                self.state.add_attachment(attachment['id'], filepath)
+        elif result is None or result == 0 or result >= 500:
+            # keep the sync cursor where it is so the next run retries this attachment,
+            # other errors like 404 for a deleted attachment will not go away by trying again
+            self.failed_channel_ids.add(variables['channel_id'])
+        mysleep(self.sleep, self.sleep_random, self.metrics)
+
+    def is_wanted_attachment(self, attachment:dict) -> bool:
+        # decided from the attachment json alone, before any request is made
+        size = attachment.get('size')
+        if size is not None:
+            if self.min_size is not None and size < self.min_size * 2**10:
+                return False
+            if self.max_size is not None and size > self.max_size * 2**10:
+                return False
+        if self.extensions and os.path.splitext(attachment['filename'])[1][1:].lower() not in self.extensions:
+            return False
+        if self.content_types:
+            content_type = attachment.get('content_type') or mimetypes.guess_type(attachment['filename'])[0] or ''
+            content_type = content_type.split(';')[0].strip()
+            if not any(fnmatch.fnmatch(content_type, pattern) for pattern in self.content_types):
+                return False
+        return True
+
+    def get_download_priority(self, attachment:dict) -> float:
+        size = attachment.get('size') or 0
+        if self.download_order == 'smallest':
+            return size
+        if self.download_order == 'largest':
+            return -size
+        return 0
+
+    def submit_attachments(self, pool:WorkerPool, message:dict, channel_variables:dict, group:TaskGroup=None) -> None:
+        message_variables = {**create_message_variables(message), **channel_variables}
+        for attachment in message['attachments']:
+            if self.stopped.is_set():
+                return
+            if 'https://cdn.discordapp.com' == attachment['url'][:27]:
+                logger.warning("Attachment not hosted by discord %s", attachment['url'])
+                continue
+            if not self.is_wanted_attachment(attachment):
+                logger.debug("Skipping attachment id %s because of the attachment filters", attachment['id'])
+                self.metrics.count('attachments', channel=channel_variables['channel_id'], result='filtered')
+                continue
+            variables = {**create_attachment_variables(attachment), **message_variables}
+            logger.debug("Format variables: %s", variables)
+            # huge files get their own lane so they do not hold up the small ones
+            lane = pool
+            if self.large_pool and (attachment.get('size') or 0) >= self.large_file_size * 2**10:
+                lane = self.large_pool
+            lane.submit(self.download_attachment, attachment, variables, group=group, priority=self.get_download_priority(attachment))
+
+    def get_newest_index_messages(self, messages:Iterator[tuple]) -> list:
+        # --sync runs append to an index so it is not ordered, keep the newest --message-count of each channel
+        newest = {}
+        for channel_id, message in messages:
+            heap, message_ids = newest.setdefault(channel_id, ([], set()))
+            if message['id'] in message_ids:
+                continue
+            if len(heap) < self.message_count:
+                heapq.heappush(heap, (int(message['id']), message))
+            elif heap and int(message['id']) > heap[0][0]:
+                _, oldest = heapq.heapreplace(heap, (int(message['id']), message))
+                message_ids.discard(oldest['id'])
+            else:
+                continue
+            message_ids.add(message['id'])
+        return [
+            (channel_id, message)
+            for channel_id, (heap, _) in newest.items()
+            for _, message in sorted(heap, key=lambda item: item[0], reverse=True)
+        ]
+
+    def process_index(self, pool:WorkerPool) -> None:
+        self.channel_template.forget_folders()
+        self.dm_template.forget_folders()
+        logger.info("Getting messages from index %s", self.import_index)
+        channels = read_index_channels(self.import_index)
+        channel_ids = set(self.channel_ids)
+        messages = (
+            (channel_id, message) for channel_id, message in read_index_messages(self.import_index)
+            if not channel_ids or channel_id in channel_ids
+        )
+        if self.message_count >= 0:
+            messages = self.get_newest_index_messages(messages)
+        # filtered a page at a time like messages from discord, a page is up to 50 consecutive lines of one channel
+        for channel_id, records in itertools.groupby(messages, key=lambda record: record[0]):
+            channel_variables = channels.get(channel_id, {'channel_id':channel_id})
+            while True:
+                page = [message for _, message in itertools.islice(records, 50)]
+                if not page:
+                    break
+                for message in self.find_messages(page):
+                    self.submit_attachments(pool, message, channel_variables)
+
+    def process_channel(self, session, pool:WorkerPool, channel_id:str) -> None:
+        with self.metrics.timer('channel', channel=channel_id):
+            self.process_channel_messages(session, pool, channel_id)
+
+    def process_channel_messages(self, session, pool:WorkerPool, channel_id:str) -> None:
+        self.failed_channel_ids.discard(channel_id)
+        self.channel_template.forget_folders()
+        self.dm_template.forget_folders()
+        # watch mode keeps its cursors in memory between polls, --sync keeps them between runs
+        last_message_id = self.cursors.get(channel_id)
+        if last_message_id is None and self.sync:
+            last_message_id = self.state.get_last_message_id(channel_id, self.get_filters_key())
+        after_id = None
+        if last_message_id:
+            logger.info("Only getting messages after message id %s for channel id %s", last_message_id, channel_id)
+            after_id = int(last_message_id)
+        # look up channel info while the first page of messages is being fetched
+        channel_info = self.metadata_executor.submit(self.get_channel_info, session, channel_id)
+        downloads = TaskGroup()
+        for message in self.get_all_messages(session, channel_id, after_id=after_id):
+            if message['attachments']:
+                self.submit_attachments(pool, message, channel_info.result(), downloads)
+        if self.index:
+            self.index.write_channel(channel_info.result())
+        if self.stopped.is_set():
+            logger.warning("Not updating sync state for channel id %s because the run was stopped", channel_id)
+            return
+        if (self.watch or self.sync and not self.simulate) and channel_id in self.newest_message_ids:
+            downloads.wait()
+            if channel_id in self.failed_channel_ids or downloads.failed:
+                logger.warning("Not updating sync state for channel id %s because some attachments failed to download", channel_id)
+                return
+            self.cursors[channel_id] = self.newest_message_ids[channel_id]
+            if self.sync and not self.simulate:
+                self.state.set_last_message_id(channel_id, self.get_filters_key(), self.newest_message_ids[channel_id])
+
+    def poll_channel(self, session, pool:WorkerPool, channel_id:str) -> None:
+        previous_message_id = self.newest_message_ids.get(channel_id)
+        try:
+            self.process_channel(session, pool, channel_id)
+        finally:
+            # busy channels are polled as often as allowed, quiet ones back off,
+            # the newest message seen is used since a failed download holds the cursor back
+            interval = self.poll_intervals.get(channel_id, self.poll_interval)
+            if self.newest_message_ids.get(channel_id) != previous_message_id:
+                interval = self.poll_interval
+            else:
+                interval = min(interval * 2, self.max_poll_interval)
+            self.poll_intervals[channel_id] = interval
+            logger.debug("Polling channel id %s again in %s seconds", channel_id, interval)
+            with self.schedule_condition:
+                heapq.heappush(self.schedule, (time.monotonic() + interval, channel_id))
+                self.schedule_condition.notify()
+
+    def watch_channels(self, session, pool:WorkerPool, channel_pool:WorkerPool) -> None:
+        # each channel is in the schedule or being polled, never both, so a slow poll is not doubled up
+        with self.schedule_condition:
+            self.schedule = [(time.monotonic(), channel_id) for channel_id in self.channel_ids]
+            heapq.heapify(self.schedule)
+        while not self.stopped.is_set():
+            with self.schedule_condition:
+                while not self.schedule or self.schedule[0][0] > time.monotonic():
+                    timeout = self.schedule[0][0] - time.monotonic() if self.schedule else None
+                    self.schedule_condition.wait(timeout)
+                _, channel_id = heapq.heappop(self.schedule)
+            channel_pool.submit(self.poll_channel, session, pool, channel_id)
 
     def run(self):
+        if self.metrics_file or self.profile_file:
+            self.metrics.enable(profiling=bool(self.profile_file))
+        try:
+            with self.metrics.profile(), self.metrics.timer('run'):
+                self.run_channels()
+        finally:
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+            if self.profile_file:
+                self.metrics.write_profile(self.profile_file)
+            self.metrics.disable()
+
+    def run_channels(self):
+        # requests is only loaded once there is something to download so importing the package stays cheap
+        import requests
+        self.request_error = requests.exceptions.RequestException
+        self.stopped.clear()
         headers = {'Authorization': self.token}
         session = requests.Session()
         session.headers.update(headers)
-        for channel_id in self.channel_ids:
-            channel_messages = self.get_all_messages(session, channel_id)
-            channel_variables = self.get_channel_info(session, channel_id)
-            for message in channel_messages:
-                for attachment in message['attachments']:
-                    if 'https://cdn.discordapp.com' == attachment['url'][:27]:
-                        logger.warning(f"Attachment not hosted by discord {attachment['url']}")
-                        continue
-                    variables = {**create_format_variables(message, attachment), **channel_variables}
-                    logger.debug(f"Format variables: {variables}")
-                    self.download_attachment(attachment, variables)
-                    mysleep(self.sleep, self.sleep_random)
\ No newline at end of file
+        # one pooled connection per channel worker
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, self.channel_concurrency))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        api = RateLimiter(session, self.max_retries, self.stopped, self.timeout, self.metrics)
+        # attachments come from the cdn which needs no token, keep its connections alive between files
+        self.cdn_session = requests.Session()
+        cdn_adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        self.cdn_session.mount('https://', cdn_adapter)
+        self.cdn_session.mount('http://', cdn_adapter)
+        # the state file also caches file hashes, it is only left out when simulating without --sync
+        if self.sync or not self.simulate:
+            self.state = StateStore(self.path)
+        pool = WorkerPool(self.concurrency, self.queue_size, metrics=self.metrics)
+        if self.large_file_size:
+            self.large_pool = WorkerPool(1, self.queue_size, 'large-download', self.metrics)
+        channel_pool = WorkerPool(self.channel_concurrency, self.channel_concurrency, 'channel', self.metrics)
+        self.metadata_executor = ThreadPoolExecutor(self.channel_concurrency, 'metadata')
+        if self.export_index:
+            # a --sync run only sees new messages so it adds to the index instead of replacing it
+            self.index = IndexWriter(self.export_index, append=self.sync)
+        try:
+            if self.import_index:
+                self.process_index(pool)
+            elif self.watch:
+                self.watch_channels(api, pool, channel_pool)
+            else:
+                for channel_id in self.channel_ids:
+                    channel_pool.submit(self.process_channel, api, pool, channel_id)
+            channel_pool.join()
+            pool.join()
+            if self.large_pool:
+                self.large_pool.join()
+        except BaseException:
+            # ctrl-c included, without this the pools would work through everything still queued before exiting
+            self.stopped.set()
+            for worker_pool in (channel_pool, pool, self.large_pool):
+                if worker_pool:
+                    worker_pool.cancel()
+            raise
+        finally:
+            channel_pool.shutdown()
+            pool.shutdown()
+            if self.large_pool:
+                self.large_pool.shutdown()
+            self.metadata_executor.shutdown()
+            if self.state:
+                self.state.close()
+            if self.index:
+                self.index.close()
+            self.cdn_session.close()
+            session.close()
+            self.progress.close()
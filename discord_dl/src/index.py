@@ -0,0 +1,66 @@
+import json
+import threading
+from typing import Iterator
+
+# everything the format variables, filters and downloads need, nothing else
+ATTACHMENT_FIELDS = ('id', 'filename', 'url', 'size', 'content_type')
+
+def compact_message(message:dict) -> dict:
+    return {
+        'id':message['id'],
+        'timestamp':message['timestamp'],
+        'author':{'id':message['author']['id'], 'username':message['author']['username']},
+        'attachments':[
+            {field:attachment[field] for field in ATTACHMENT_FIELDS if field in attachment}
+            for attachment in message['attachments']
+        ],
+    }
+
+class IndexWriter():
+    # one json object per line so an index can be read back without loading all of it
+
+    def __init__(self, filepath:str, append:bool=False) -> None:
+        self.lock = threading.Lock()
+        self.file = open(filepath, 'a' if append else 'w', encoding='utf-8')
+        # --watch processes the same channels over and over, their info is only written again when it changed
+        self.channels = {}
+
+    def write(self, records:list) -> None:
+        lines = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        with self.lock:
+            self.file.write(lines)
+
+    def write_channel(self, channel_variables:dict) -> None:
+        with self.lock:
+            if self.channels.get(channel_variables['channel_id']) == channel_variables:
+                return
+            self.channels[channel_variables['channel_id']] = channel_variables
+        self.write([{'type':'channel', 'variables':channel_variables}])
+
+    def write_messages(self, channel_id:str, messages:list) -> None:
+        # messages without attachments can never be downloaded from so they are left out
+        self.write([
+            {'type':'message', 'channel_id':channel_id, 'message':compact_message(message)}
+            for message in messages if message['attachments']
+        ])
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+def read_index(filepath:str) -> Iterator[dict]:
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_index_channels(filepath:str) -> dict:
+    return {
+        record['variables']['channel_id']:record['variables']
+        for record in read_index(filepath) if record['type'] == 'channel'
+    }
+
+def read_index_messages(filepath:str) -> Iterator[tuple]:
+    for record in read_index(filepath):
+        if record['type'] == 'message':
+            yield record['channel_id'], record['message']
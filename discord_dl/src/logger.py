@@ -1,15 +1,20 @@
 import logging
-from src.arguments import get_args
 
-args = get_args()
 logger = logging.getLogger('discord_dl')
+# stay silent when used as a library until the application configures logging
+logger.addHandler(logging.NullHandler())
 
-logging_level = logging.WARNING if args.quiet else logging.INFO
-logging_level = logging.DEBUG if args.verbose else logging_level
-logger.setLevel(logging_level)
+def configure_logger(verbose:bool=False, quiet:bool=False) -> None:
+    logging_level = logging.WARNING if quiet else logging.INFO
+    logging_level = logging.DEBUG if verbose else logging_level
+    logger.setLevel(logging_level)
 
-formatter = logging.Formatter('%(levelname)s: %(message)s')
+    # safe to call again, the handler is only added once
+    if any(isinstance(handler, logging.StreamHandler) for handler in logger.handlers):
+        return
 
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
\ No newline at end of file
+    formatter = logging.Formatter('%(levelname)s: %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
@@ -0,0 +1,122 @@
+import contextlib
+import json
+import threading
+import time
+
+class Metrics():
+    # counters and timers labelled by channel, route etc, everything is a no-op until enabled,
+    # each downloader has its own so jobs running side by side in one process do not mix
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.profiling = False
+        self.counters = {}
+        self.timers = {}
+        self.profiles = []
+
+    def enable(self, profiling:bool=False) -> None:
+        with self.lock:
+            self.enabled = True
+            self.profiling = profiling
+            self.counters = {}
+            self.timers = {}
+            self.profiles = []
+
+    def disable(self) -> None:
+        # a downloader that is run again should not keep profiling or collecting
+        with self.lock:
+            self.enabled = False
+            self.profiling = False
+            self.counters = {}
+            self.timers = {}
+            self.profiles = []
+
+    def count(self, name:str, value:int=1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_time(self, name:str, seconds:float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total = self.timers.get(key, (0, 0.0))
+            self.timers[key] = (count + 1, total + seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name:str, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, **labels)
+
+    @contextlib.contextmanager
+    def profile(self):
+        # cProfile only sees the thread it was enabled in so every worker thread gets its own
+        if not self.profiling:
+            yield
+            return
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'counters':[
+                    {'name':name, 'labels':dict(labels), 'value':value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'timers':[
+                    {'name':name, 'labels':dict(labels), 'count':count, 'seconds':seconds}
+                    for (name, labels), (count, seconds) in sorted(self.timers.items())
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        summary = self.to_dict()
+        for counter in summary['counters']:
+            lines.append(f"discord_dl_{counter['name']}_total{format_labels(counter['labels'])} {counter['value']}")
+        for timer in summary['timers']:
+            labels = format_labels(timer['labels'])
+            lines.append(f"discord_dl_{timer['name']}_seconds_total{labels} {timer['seconds']}")
+            lines.append(f"discord_dl_{timer['name']}_count{labels} {timer['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filepath:str) -> None:
+        with open(filepath, 'w', encoding='utf-8') as f:
+            if filepath.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=4)
+
+    def write_profile(self, filepath:str) -> None:
+        with self.lock:
+            profiles = list(self.profiles)
+        if profiles:
+            import pstats
+            pstats.Stats(*profiles).dump_stats(filepath)
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels:dict) -> str:
+    if not labels:
+        return ''
+    values = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+    return f'{{{values}}}'
@@ -0,0 +1,71 @@
+import threading
+import time
+from .utils import print_download_bar
+
+# one combined download bar for every transfer that is currently in flight,
+# redrawn by its own thread at a fixed rate so transfers only add up bytes
+class Progress():
+
+    def __init__(self, enabled:bool=True, interval:float=0.2) -> None:
+        self.enabled = enabled
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.active = 0
+        self.unknown = 0
+        self.total = 0
+        self.downloaded = 0
+        self.start = 0
+        self.bar_len = 0
+
+    def begin(self, total:int) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.active == 0:
+                self.unknown = 0
+                self.total = 0
+                self.downloaded = 0
+                self.start = time.time()
+                self.bar_len = 0
+            self.active += 1
+            self.total += total
+            if not total:
+                self.unknown += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.render, name='progress', daemon=True)
+                self.thread.start()
+
+    def update(self, size:int) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.downloaded += size
+
+    def end(self) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.draw()
+                print()
+
+    def draw(self) -> None:
+        # a single transfer without content-length makes the combined total unknown
+        total = 0 if self.unknown else self.total
+        self.bar_len = print_download_bar(total, self.downloaded, self.start, self.bar_len)
+
+    def render(self) -> None:
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if self.active:
+                    self.draw()
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.stopped.clear()
@@ -0,0 +1,124 @@
+import re
+import threading
+import time
+from .logger import logger
+from .metrics import Metrics
+
+class Bucket():
+
+    def __init__(self) -> None:
+        self.remaining = None
+        self.reset_at = 0.0
+
+class RateLimiter():
+    # sends discord api requests as fast as their rate limit buckets allow
+
+    def __init__(self, session, max_retries:int, stopped:threading.Event=None, timeout:float=None, metrics:Metrics=None) -> None:
+        # loaded here rather than at import so importing the package stays cheap
+        import requests
+        self.connection_error = requests.exceptions.ConnectionError
+        self.retried_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        self.session = session
+        self.metrics = metrics or Metrics()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # waits end early once set so a stopping run is not held up by a rate limit
+        self.stopped = stopped or threading.Event()
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.buckets = {}
+        self.global_reset_at = 0.0
+
+    def get_route(self, url:str) -> str:
+        # requests to different channels or guilds never share a bucket
+        return re.sub(r'\?.*$', '', url)
+
+    def get_bucket(self, route:str) -> Bucket:
+        bucket_key = self.routes.get(route, route)
+        if bucket_key not in self.buckets:
+            self.buckets[bucket_key] = Bucket()
+        return self.buckets[bucket_key]
+
+    def acquire(self, route:str) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                bucket = self.get_bucket(route)
+                if bucket.reset_at <= now:
+                    bucket.remaining = None
+                wait = self.global_reset_at - now
+                if wait <= 0 and bucket.remaining == 0:
+                    wait = bucket.reset_at - now
+                if wait <= 0:
+                    # claim a request slot so parallel callers can not overshoot the bucket
+                    if bucket.remaining is not None:
+                        bucket.remaining -= 1
+                    return
+            logger.debug("Waiting %.2f seconds for rate limit on %s", wait, route)
+            self.metrics.add_time('rate_limit_wait', wait)
+            if self.stopped.wait(wait):
+                return
+
+    def update(self, route:str, response) -> None:
+        headers = response.headers
+        with self.lock:
+            now = time.monotonic()
+            bucket_hash = headers.get('X-RateLimit-Bucket')
+            if bucket_hash:
+                major = re.search(r'/(?:channels|guilds)/(\d+)', route)
+                bucket_key = f"{bucket_hash}:{major.group(1) if major else ''}"
+                if self.routes.get(route) != bucket_key:
+                    self.routes[route] = bucket_key
+                    self.buckets.setdefault(bucket_key, Bucket())
+            bucket = self.get_bucket(route)
+            if 'X-RateLimit-Remaining' in headers:
+                bucket.remaining = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset-After' in headers:
+                bucket.reset_at = now + float(headers['X-RateLimit-Reset-After'])
+            if response.status_code == 429:
+                retry_after = self.get_retry_after(response)
+                if headers.get('X-RateLimit-Global') or headers.get('X-RateLimit-Scope') == 'global':
+                    self.global_reset_at = now + retry_after
+                else:
+                    bucket.remaining = 0
+                    bucket.reset_at = now + retry_after
+
+    def get_retry_after(self, response) -> float:
+        try:
+            return float(response.json()['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get('Retry-After', 1))
+
+    def get(self, url:str, **kwargs):
+        route = self.get_route(url)
+        # ids removed so metrics are per kind of request
+        request_type = re.sub(r'/\d+', '/{id}', route.split('/api/v9', 1)[-1])
+        retries = 0
+        while True:
+            self.acquire(route)
+            try:
+                with self.metrics.timer('api_request', route=request_type):
+                    response = self.session.get(url, timeout=self.timeout, **kwargs)
+            except self.retried_errors as e:
+                response = None
+                logger.warning("Connection error for url: %s %r", url, e)
+            else:
+                self.metrics.count('api_requests', route=request_type, status=response.status_code)
+                self.update(route, response)
+                if response.status_code == 429 and not self.stopped.is_set():
+                    logger.warning("429 Rate limited for %s seconds on url: %s", self.get_retry_after(response), url)
+                    continue
+                if response.status_code < 500:
+                    return response
+                logger.warning("%s Failed to get url: %s", response.status_code, url)
+            retries += 1
+            if retries >= self.max_retries or self.stopped.is_set():
+                if response is None:
+                    raise self.connection_error(f"Failed to connect to url: {url}")
+                return response
+            sleep = min(2 ** retries, 60)
+            self.metrics.count('api_retries', route=request_type)
+            self.metrics.add_time('retry_sleep', sleep)
+            logger.info("Sleeping for %s seconds", sleep)
+            self.stopped.wait(sleep)
+            logger.info("Retrying request %s/%s", retries, self.max_retries)
@@ -0,0 +1,130 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_FILENAME = '.discord_dl.sqlite3'
+
+class StateStore():
+
+    def __init__(self, path:str) -> None:
+        self.filepath = os.path.join(path, STATE_FILENAME)
+        # shared by the download workers, sqlite3 connections are not thread safe on their own
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS channels (
+                    channel_id TEXT NOT NULL,
+                    filters TEXT NOT NULL,
+                    last_message_id TEXT NOT NULL,
+                    PRIMARY KEY (channel_id, filters)
+                );
+                CREATE TABLE IF NOT EXISTS attachments (
+                    attachment_id TEXT PRIMARY KEY,
+                    filepath TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS hashes (
+                    filepath TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    md5 TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS hashes_content ON hashes (size, md5);
+                CREATE TABLE IF NOT EXISTS metadata (
+                    kind TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (kind, id)
+                );
+            ''')
+
+    def get_last_message_id(self, channel_id:str, filters:str) -> str:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT last_message_id FROM channels WHERE channel_id = ? AND filters = ?',
+                (channel_id, filters)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_last_message_id(self, channel_id:str, filters:str, message_id:str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO channels (channel_id, filters, last_message_id) VALUES (?, ?, ?)',
+                (channel_id, filters, message_id)
+            )
+
+    def is_downloaded(self, attachment_id:str, filepath:str) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT filepath FROM attachments WHERE attachment_id = ?',
+                (attachment_id,)
+            ).fetchone()
+        return row is not None and row[0] == filepath and os.path.exists(filepath)
+
+    def add_attachment(self, attachment_id:str, filepath:str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO attachments (attachment_id, filepath) VALUES (?, ?)',
+                (attachment_id, filepath)
+            )
+
+    def get_md5(self, filepath:str, size:int, mtime_ns:int) -> str:
+        # a cached hash is only trusted while the file keeps the size and mtime it was hashed at
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT md5 FROM hashes WHERE filepath = ? AND size = ? AND mtime_ns = ?',
+                (filepath, size, mtime_ns)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_md5(self, filepath:str, size:int, mtime_ns:int, md5:str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO hashes (filepath, size, mtime_ns, md5) VALUES (?, ?, ?, ?)',
+                (filepath, size, mtime_ns, md5)
+            )
+
+    def has_size(self, size:int) -> bool:
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM hashes WHERE size = ? LIMIT 1', (size,)).fetchone()
+        return row is not None
+
+    def find_file(self, md5:str, size:int) -> str:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT filepath, mtime_ns FROM hashes WHERE size = ? AND md5 = ?',
+                (size, md5)
+            ).fetchall()
+        for filepath, mtime_ns in rows:
+            # skip files that were deleted or changed since they were hashed
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                return filepath
+        return None
+
+    def get_metadata(self, kind:str, id:str, ttl:float) -> dict:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM metadata WHERE kind = ? AND id = ? AND fetched_at > ?',
+                (kind, id, time.time() - ttl)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_metadata(self, kind:str, id:str, data:dict) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO metadata (kind, id, data, fetched_at) VALUES (?, ?, ?, ?)',
+                (kind, id, json.dumps(data), time.time())
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
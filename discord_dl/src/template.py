@@ -0,0 +1,95 @@
+import os
+import re
+import string
+from datetime import datetime, timezone
+from .utils import sanitize_filename, sanitize_foldername
+
+MESSAGE_VARIABLES = ('id', 'filename', 'ext', 'message_id', 'date', 'username', 'user_id')
+CHANNEL_VARIABLES = ('channel_id',)
+SERVER_VARIABLES = ('channel_name', 'channel_topic', 'server_id', 'server_name', 'server_owner_id')
+# folders named after messages would otherwise grow the caches for as long as --watch runs
+MAX_CACHED_FOLDERS = 4096
+
+def split_template(template:str) -> list:
+    components = []
+    while template:
+        head, tail = os.path.split(template)
+        if head == template:
+            break
+        components.insert(0, tail)
+        template = head
+    return components
+
+def get_template_fields(component:str, allowed:tuple) -> list:
+    fields = []
+    for _, field_name, _, _ in string.Formatter().parse(component):
+        if field_name is None:
+            continue
+        # {date.year} and {filename[0]} still only use the date and filename variables
+        name = re.match(r'[^.\[]*', field_name).group(0)
+        if name not in allowed:
+            raise ValueError(f"unknown format variable '{{{name}}}'")
+        fields.append(name)
+    return fields
+
+class PathTemplate():
+    # a format template split and checked once, then filled in for every attachment
+
+    def __init__(self, template:str, path:str, windows_filenames:bool, restrict_filenames:bool, server:bool=True) -> None:
+        self.template = template
+        self.path = path
+        self.windows_filenames = windows_filenames
+        self.restrict_filenames = restrict_filenames
+        self.folder_cache = {}
+        self.created_folders = set()
+        allowed = MESSAGE_VARIABLES + CHANNEL_VARIABLES + (SERVER_VARIABLES if server else ())
+        try:
+            components = split_template(template)
+            if not components:
+                raise ValueError('template is empty')
+            self.folders = []
+            for component in components[:-1]:
+                fields = get_template_fields(component, allowed)
+                # folders made from channel variables only are the same for every attachment in a channel
+                if all(field in CHANNEL_VARIABLES + SERVER_VARIABLES for field in fields):
+                    self.folders.append((component, tuple(fields)))
+                else:
+                    self.folders.append((component, None))
+            get_template_fields(components[-1], allowed)
+            self.filename = components[-1]
+            # fill in sample values so bad format specs fail now instead of on the first attachment
+            sample = {name: '0' for name in allowed}
+            sample['date'] = datetime.now(timezone.utc)
+            self.format(sample)
+        except (ValueError, KeyError, IndexError, AttributeError, TypeError) as e:
+            raise ValueError(f"Invalid format template '{template}': {e}") from e
+        self.folder_cache.clear()
+
+    def format(self, variables:dict) -> str:
+        components = [self.path]
+        for index, (component, fields) in enumerate(self.folders):
+            if fields is None:
+                components.append(sanitize_foldername(component.format(**variables), self.windows_filenames, self.restrict_filenames))
+                continue
+            key = (index, *(variables[field] for field in fields))
+            folder = self.folder_cache.get(key)
+            if folder is None:
+                folder = sanitize_foldername(component.format(**variables), self.windows_filenames, self.restrict_filenames)
+                if len(self.folder_cache) >= MAX_CACHED_FOLDERS:
+                    self.folder_cache.clear()
+                self.folder_cache[key] = folder
+            components.append(folder)
+        components.append(sanitize_filename(self.filename.format(**variables), self.windows_filenames, self.restrict_filenames))
+        return os.path.join(*components)
+
+    def makedirs(self, folder:str) -> None:
+        if folder in self.created_folders:
+            return
+        os.makedirs(folder, exist_ok=True)
+        if len(self.created_folders) >= MAX_CACHED_FOLDERS:
+            self.created_folders.clear()
+        self.created_folders.add(folder)
+
+    def forget_folders(self) -> None:
+        # folders can be deleted between runs or --watch polls, so they are only trusted for one channel pass
+        self.created_folders.clear()
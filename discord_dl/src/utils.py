@@ -1,66 +1,99 @@
 import hashlib
-import requests
 import os
 import time
 import re
 import random
-from datetime import datetime
-from src.logger import logger
+import shutil
+from datetime import datetime, timezone
+from .logger import logger
+from .metrics import Metrics
 
-def create_format_variables(message:dict, attachment:dict, index:int=0) -> dict:
+HASH_CHUNK_SIZE = 2**20
+DOWNLOAD_CHUNK_SIZE = 2**18
+
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x1f]')
+WINDOWS_RESERVED_CHARACTERS = re.compile(r'[<>:\"/\\\|\?\*]')
+NON_ASCII_CHARACTERS = re.compile(r'[^\x21-\x7f]')
+
+# milliseconds since the unix epoch of the first second of 2015, the start of discord snowflake time
+DISCORD_EPOCH = 1420070400000
+
+def create_message_variables(message:dict) -> dict:
     variables = {
-        'filename':os.path.splitext(attachment['filename'])[0],
-        'ext':os.path.splitext(attachment['filename'])[1][1:],
         'message_id':message['id'],
-        'id':attachment['id'],
         'date':convert_discord_timestamp(message['timestamp']),
         'username':message['author']['username'],
         'user_id':message['author']['id'],
     }
     return variables
 
-def create_filepath(variables:dict, path:str, channel_format_template:str, dm_format_template:str, win_filenames:bool, restrict_filenames:bool) -> str:
-    format_template = channel_format_template if 'server_id' in variables else dm_format_template
-    components = []
-    first = True
-    while format_template:
-        head, tail = os.path.split(format_template)
-        if first:
-            components.insert(0, sanitize_filename(tail.format(**variables), win_filenames, restrict_filenames))
-            first = False
-        else:
-            components.insert(0, sanitize_foldername(tail.format(**variables), win_filenames, restrict_filenames))
-        format_template = head
-    components.insert(0, path)
-    filepath = os.path.join(*components)
-    return filepath  
+def create_attachment_variables(attachment:dict) -> dict:
+    filename, ext = os.path.splitext(attachment['filename'])
+    variables = {
+        'filename':filename,
+        'ext':ext[1:],
+        'id':attachment['id'],
+    }
+    return variables
 
-def mysleep(sleep_base:int, sleep_range:list):
+def mysleep(sleep_base:int, sleep_range:list, metrics:Metrics=None):
+    metrics = metrics or Metrics()
     if sleep_base or (sleep_range[0] != 0 and sleep_range[1] != 0):
         sleep = sleep_base + random.uniform(sleep_range[0], sleep_range[1])
-        logger.info(f"Sleeping for {sleep} seconds")
+        logger.info("Sleeping for %s seconds", sleep)
+        metrics.add_time('sleep', sleep)
         time.sleep(sleep)
 
 def convert_discord_timestamp(timestamp):
     try:
-        return datetime.strptime(timestamp, r"%Y-%m-%dT%H:%M:%S.%f%z")
+        return datetime.fromisoformat(timestamp)
     except ValueError:
-        return datetime.strptime(timestamp, r"%Y-%m-%dT%H:%M:%S%z")
+        # fromisoformat only accepts 3 or 6 fractional digits before python 3.11
+        try:
+            return datetime.strptime(timestamp, r"%Y-%m-%dT%H:%M:%S.%f%z")
+        except ValueError:
+            return datetime.strptime(timestamp, r"%Y-%m-%dT%H:%M:%S%z")
 
-def calculate_md5(file_path) -> str:
+def datetime_to_snowflake(date:datetime) -> int:
+    # naive dates from the command line are UTC, like the message timestamps they are compared with
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return (int(date.timestamp() * 1000) - DISCORD_EPOCH) << 22
+
+def calculate_md5(file_path, metrics:Metrics=None) -> str:
+    metrics = metrics or Metrics()
     hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with metrics.timer('hash'), open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
             hash_md5.update(chunk)
+            metrics.count('hashed_bytes', len(chunk))
     return hash_md5.hexdigest()
 
+def get_file_md5(file_path, hashes=None, metrics:Metrics=None) -> str:
+    if hashes is None:
+        return calculate_md5(file_path, metrics)
+    stat = os.stat(file_path)
+    md5 = hashes.get_md5(file_path, stat.st_size, stat.st_mtime_ns)
+    if md5 is None:
+        logger.debug("Hashing existing file: %s", file_path)
+        md5 = calculate_md5(file_path, metrics)
+        hashes.set_md5(file_path, stat.st_size, stat.st_mtime_ns, md5)
+    return md5
+
+def link_file(source:str, destination:str) -> None:
+    # hardlinks cost no extra space, copy when the file system or the folders do not allow one
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
 def sanitize_filename(string, windows_naming, restrict_filenames):
-    string = re.sub(r'[/]', '_', string)
-    string = re.sub(r'[\x00-\x1f]', '', string)
+    string = string.replace('/', '_')
+    string = CONTROL_CHARACTERS.sub('', string)
     if os.name == 'nt' or windows_naming:
-        string = re.sub(r'[<>:\"/\\\|\?\*]', '_', string)
+        string = WINDOWS_RESERVED_CHARACTERS.sub('_', string)
     if restrict_filenames:
-        string = re.sub(r'[^\x21-\x7f]', '_', string)
+        string = NON_ASCII_CHARACTERS.sub('_', string)
     return string
 
 def sanitize_foldername(string, windows_naming, restrict_filenames):
@@ -78,42 +111,113 @@ def extract_channel_ids(channel_ids):
         if match:
             results.append(match.group(1) if match.group(1) else match.group(3))
         else:
-            logger.warning(f'Could not find discord channel id in: {channel_id}')
+            logger.warning('Could not find discord channel id in: %s', channel_id)
     return results
 
-def download(url:str, filepath:str, simulate=False) -> None:
+def remove_partial_download(part_filepath:str) -> None:
+    for path in (part_filepath, f'{part_filepath}.etag'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def download(session, url:str, filepath:str, progress, simulate=False, hashes=None, chunk_size:int=DOWNLOAD_CHUNK_SIZE, stopped=None, timeout:float=None, metrics:Metrics=None) -> None:
+    metrics = metrics or Metrics()
     file_path, filename = os.path.split(filepath)
-    logger.info(f"Downloading: {filename}")
-    logger.debug(f"Path: {file_path}")
-    logger.debug(f"URL: {url}")
+    logger.info("Downloading: %s", filename)
+    logger.debug("Path: %s", file_path)
+    logger.debug("URL: %s", url)
 
-    local_md5 = calculate_md5(filepath) if os.path.exists(filepath) else None
-    with requests.get(url, stream=True) as r:
-        if r.status_code != 200:
+    local_md5 = get_file_md5(filepath, hashes, metrics) if os.path.exists(filepath) else None
+    # let the server answer 304 instead of sending a file we already have
+    headers = {'If-None-Match': f'"{local_md5}"'} if local_md5 else {}
+    part_filepath = f'{filepath}.part'
+    # the etag the .part file was started from, its bytes can only be continued from that same file
+    etag_filepath = f'{part_filepath}.etag'
+    part_etag = None
+    resume_from = 0
+    if not simulate and os.path.exists(part_filepath):
+        if os.path.exists(etag_filepath):
+            with open(etag_filepath, 'r', encoding='utf-8') as f:
+                part_etag = f.read().strip()
+        if part_etag:
+            resume_from = os.path.getsize(part_filepath)
+        else:
+            logger.debug("No etag saved for the partial file, starting over")
+    if resume_from:
+        logger.debug("Resuming download from byte %s", resume_from)
+        headers['Range'] = f'bytes={resume_from}-'
+        # the server sends the whole file instead of a range if it changed since
+        headers['If-Range'] = part_etag
+    # a stalled transfer raises after timeout seconds without data and is resumed from the .part file
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            if not simulate:
+                remove_partial_download(part_filepath)
+            return 1
+        if r.status_code == 416:
+            # the partial file does not fit the file on the server anymore
+            logger.debug("Server rejected the resume range, starting over")
+            remove_partial_download(part_filepath)
+            return download(session, url, filepath, progress, simulate, hashes, chunk_size, stopped, timeout, metrics)
+        if r.status_code not in (200, 206):
             return r.status_code
         server_md5 = r.headers.get('ETag', '')
         if not server_md5:
             logger.warning("No server hash found for attachment")
         if server_md5 == f'"{local_md5}"':
+            if not simulate:
+                remove_partial_download(part_filepath)
             return 1
+        if r.status_code == 206 and resume_from:
+            if server_md5 != part_etag or not r.headers.get('Content-Range', '').startswith(f'bytes {resume_from}-'):
+                logger.debug("Server answered with a different file or range, starting over")
+                remove_partial_download(part_filepath)
+                return download(session, url, filepath, progress, simulate, hashes, chunk_size, stopped, timeout, metrics)
+        else:
+            resume_from = 0
         total = int(r.headers.get('content-length', 0))
-        if not os.path.exists(file_path):
-            logger.debug("Creating Path because it did not exist")
-            os.makedirs(file_path)
-        start = time.time()
         if simulate:
-            print_download_bar(1, 1, start, 0)
-            print()
+            progress.begin(1)
+            progress.update(1)
+            progress.end()
             return 200
-        with open(filepath, 'wb') as f:
-            bar_len = 0
-            downloaded = 0
-            for chunk in r.iter_content(chunk_size=8192):
-                downloaded += len(chunk) 
-                f.write(chunk)
-                bar_len = print_download_bar(total, downloaded, start, bar_len)
-        print()
-    return r.status_code
+        hash_md5 = hashlib.md5()
+        if resume_from:
+            metrics.count('resumed_bytes', resume_from)
+            with metrics.timer('hash'), open(part_filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    hash_md5.update(chunk)
+        if not resume_from:
+            with open(etag_filepath, 'w', encoding='utf-8') as f:
+                f.write(server_md5)
+        progress.begin(total)
+        transferred = 0
+        start = time.perf_counter()
+        try:
+            with open(part_filepath, 'ab' if resume_from else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if stopped is not None and stopped.is_set():
+                        # the .part file is resumed by the next run
+                        return None
+                    f.write(chunk)
+                    hash_md5.update(chunk)
+                    transferred += len(chunk)
+                    progress.update(len(chunk))
+        finally:
+            progress.end()
+            metrics.add_time('transfer', time.perf_counter() - start)
+            metrics.count('transferred_bytes', transferred)
+    md5 = hash_md5.hexdigest()
+    # multipart uploads get etags that are not an md5 of the whole file
+    if re.fullmatch(r'"[0-9a-f]{32}"', server_md5) and server_md5 != f'"{md5}"':
+        logger.warning("Downloaded file hash %s does not match server hash %s", md5, server_md5)
+        remove_partial_download(part_filepath)
+        return 0
+    os.replace(part_filepath, filepath)
+    os.remove(etag_filepath)
+    if hashes is not None:
+        stat = os.stat(filepath)
+        hashes.set_md5(filepath, stat.st_size, stat.st_mtime_ns, md5)
+    return 200
 
 def calculate_bytes(bytes:str):
     if bytes/2**10 < 100:
@@ -139,7 +243,8 @@ def print_download_bar(total, downloaded, start, bar_len) -> None:
     td = time.time() - start
     td = 0.0000001 if td == 0 else td
     rate, rate_size = calculate_bytes((downloaded)/td)
-    eta = time.strftime("%H:%M:%S", time.gmtime((total-downloaded) / (downloaded/td)))
+    # the bar can be drawn before the first byte arrived
+    eta = time.strftime("%H:%M:%S", time.gmtime((total-downloaded) / (downloaded/td))) if downloaded else '??:??:??'
 
     if total:
         done = int(50*downloaded/total)
@@ -0,0 +1,96 @@
+import itertools
+import queue
+import threading
+from .logger import logger
+from .metrics import Metrics
+
+class TaskGroup():
+    # counts the unfinished and failed tasks of one channel so it can wait for just its own downloads
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.failed = 0
+
+    def add(self) -> None:
+        with self.condition:
+            self.pending += 1
+
+    def done(self, failed:bool=False) -> None:
+        with self.condition:
+            self.pending -= 1
+            if failed:
+                self.failed += 1
+            if self.pending == 0:
+                self.condition.notify_all()
+
+    def wait(self) -> None:
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+class WorkerPool():
+
+    def __init__(self, workers:int, queue_size:int, name:str='download', metrics:Metrics=None) -> None:
+        self.metrics = metrics or Metrics()
+        # bounded so producers block instead of buffering a whole channel of tasks,
+        # queued tasks run lowest priority first and in submit order for equal priorities
+        self.tasks = queue.PriorityQueue(maxsize=queue_size)
+        self.order = itertools.count()
+        self.cancelled = threading.Event()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name=f'{name}-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self) -> None:
+        with self.metrics.profile():
+            self.work_tasks()
+
+    def work_tasks(self) -> None:
+        while True:
+            _, _, task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                break
+            func, args, group = task
+            failed = True
+            try:
+                if not self.cancelled.is_set():
+                    func(*args)
+                    failed = False
+            except Exception as e:
+                logger.error("%s task failed: %r", threading.current_thread().name, e)
+            finally:
+                if group is not None:
+                    group.done(failed)
+                self.tasks.task_done()
+
+    def submit(self, func, *args, group:TaskGroup=None, priority:float=0) -> None:
+        if self.cancelled.is_set():
+            return
+        if group is not None:
+            group.add()
+        self.tasks.put((priority, next(self.order), (func, args, group)))
+
+    def join(self) -> None:
+        self.tasks.join()
+
+    def cancel(self) -> None:
+        # queued tasks are dropped and count as failed, running ones are left to finish
+        self.cancelled.set()
+        while True:
+            try:
+                _, _, task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None and task[2] is not None:
+                task[2].done(True)
+            self.tasks.task_done()
+
+    def shutdown(self) -> None:
+        for _ in self.threads:
+            self.tasks.put((float('inf'), next(self.order), None))
+        for thread in self.threads:
+            thread.join()